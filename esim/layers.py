@@ -3,10 +3,9 @@ Definition of custom layers for the ESIM model.
 """
 # Aurelien Coet, 2018.
 
+import torch
 import torch.nn as nn
 
-from .utils import sort_by_seq_lens, masked_softmax, weighted_sum
-
 
 # Class widely inspired from:
 # https://github.com/allenai/allennlp/blob/master/allennlp/modules/input_variational_dropout.py
@@ -30,11 +29,17 @@ class RNNDropout(nn.Dropout):
         Returns:
             A new tensor on which dropout has been applied.
         """
-        ones = sequences_batch.data.new_ones(sequences_batch.shape[0],
-                                             sequences_batch.shape[-1])
-        dropout_mask = nn.functional.dropout(ones, self.p, self.training,
-                                             inplace=False)
-        return dropout_mask.unsqueeze(1) * sequences_batch
+        if not self.training or self.p == 0.0:
+            return sequences_batch
+        if self.p == 1.0:
+            return sequences_batch * 0.0
+
+        keep_prob = 1.0 - self.p
+        dropout_mask = sequences_batch.new_empty(sequences_batch.shape[0],
+                                                 1,
+                                                 sequences_batch.shape[-1])
+        dropout_mask.bernoulli_(keep_prob).div_(keep_prob)
+        return dropout_mask * sequences_batch
 
 
 class Seq2SeqEncoder(nn.Module):
@@ -46,7 +51,9 @@ class Seq2SeqEncoder(nn.Module):
     that have different lengths and that need to be passed through a RNN.
     The sequences are sorted in descending order of their lengths, packed,
     passed through the RNN, and the resulting sequences are then padded and
-    permuted back to the original order of the input sequences.
+    permuted back to the original order of the input sequences. Sorting is
+    skipped for batches that are already sorted, and packing is skipped
+    for batches of sequences that all have the same length.
     """
 
     def __init__(self,
@@ -97,6 +104,101 @@ class Seq2SeqEncoder(nn.Module):
                                  dropout=dropout,
                                  bidirectional=bidirectional)
 
+        # Static buffers of the CUDA graph set by 'capture_graph', and the
+        # addresses of the weights of the encoder it was captured with.
+        self._graph = None
+        self._graph_input = None
+        self._graph_output = None
+        self._graph_weights_ptrs = None
+
+    def capture_graph(self, sequences_batch):
+        """
+        Capture the encoder in a CUDA graph to replay it for inference on
+        batches of sequences that all have the same size as
+        'sequences_batch', without the overhead of launching its kernels
+        one by one.
+
+        The graph is captured with the module in evaluation mode. It is only
+        replayed when the module is in evaluation mode and gradients are
+        disabled (for example under torch.no_grad()), on batches with the
+        same size, type and device as 'sequences_batch'. The graph is
+        dropped when the module is moved or cast (with .to(), .half(),
+        ...), and must then be captured again. Once captured, the
+        graph is replayed and its outputs are checked against those of the
+        eager encoder.
+
+        Args:
+            sequences_batch: A sample batch of sequences of vectors that all
+                have the same length, on a CUDA device. The batch is assumed
+                to be of size (batch, sequence, vector_dim).
+
+        Raises:
+            RuntimeError: If the outputs of the replayed graph do not match
+                the outputs of the eager encoder.
+        """
+        static_input = sequences_batch.detach().clone()
+
+        was_training = self.training
+        self.eval()
+        try:
+            with torch.no_grad():
+                # Warm up on a side stream before capturing, as required by
+                # CUDA graphs.
+                stream = torch.cuda.Stream()
+                stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(stream):
+                    for _ in range(3):
+                        eager_output, _ = self._encoder(static_input, None)
+                torch.cuda.current_stream().wait_stream(stream)
+
+                graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(graph):
+                    static_output, _ = self._encoder(static_input, None)
+
+                graph.replay()
+                if not torch.allclose(static_output, eager_output,
+                                      rtol=1e-4, atol=1e-5):
+                    raise RuntimeError("The outputs of the captured CUDA "
+                                       "graph do not match the outputs of "
+                                       "the eager encoder.")
+        finally:
+            self.train(was_training)
+
+        self._graph = graph
+        self._graph_input = static_input
+        self._graph_output = static_output
+        self._graph_weights_ptrs = self._weights_ptrs()
+
+    def _weights_ptrs(self):
+        """
+        Get the addresses of the weights of the encoder, which are baked
+        into a captured CUDA graph.
+        """
+        return [weight.data_ptr() for weight in self._encoder._flat_weights]
+
+    def _can_replay_graph(self, sequences_batch):
+        """
+        Check whether the captured CUDA graph can be replayed on a batch of
+        sequences that all have the same length.
+        """
+        return self._graph is not None\
+            and not self.training\
+            and not torch.is_grad_enabled()\
+            and sequences_batch.shape == self._graph_input.shape\
+            and sequences_batch.dtype == self._graph_input.dtype\
+            and sequences_batch.device == self._graph_input.device\
+            and self._weights_ptrs() == self._graph_weights_ptrs
+
+    def _apply(self, fn, *args, **kwargs):
+        # Moving or casting the module (with .to(), .half(), ...) may
+        # reallocate the weights that a captured graph points to, so the
+        # graph is dropped.
+        self._graph = None
+        self._graph_input = None
+        self._graph_output = None
+        self._graph_weights_ptrs = None
+        return super(Seq2SeqEncoder, self)._apply(fn, *args, **kwargs)
+
     def forward(self, sequences_batch, sequences_lengths):
         """
         Args:
@@ -104,25 +206,47 @@ class Seq2SeqEncoder(nn.Module):
                 The batch is assumed to be of size
                 (batch, sequence, vector_dim).
             sequences_lengths: A 1D tensor containing the sizes of the
-                sequences in the input batch.
+                sequences in the input batch. Passing it on the CPU avoids
+                a device to host copy.
 
         Returns:
-            reordered_outputs: The outputs (hidden states) of the encoder for
+            outputs: The outputs (hidden states) of the encoder for
                 the sequences in the input batch, in the same order.
         """
-        sorted_batch, sorted_lengths, _, restoration_idx =\
-            sort_by_seq_lens(sequences_batch, sequences_lengths)
-        packed_batch = nn.utils.rnn.pack_padded_sequence(sorted_batch,
-                                                         sorted_lengths,
-                                                         batch_first=True)
+        # The lengths are needed on the CPU to pack the sequences. They are
+        # moved there once to avoid implicit synchronisations later on.
+        sequences_lengths = sequences_lengths.cpu()
+
+        # Sequences of the same length need neither sorting nor packing.
+        if (sequences_lengths == sequences_lengths[0]).all():
+            max_length = int(sequences_lengths[0])
+            sequences_batch = sequences_batch[:, :max_length]
+
+            if self._can_replay_graph(sequences_batch):
+                self._graph_input.copy_(sequences_batch, non_blocking=True)
+                self._graph.replay()
+                return self._graph_output.clone()
+
+            outputs, _ = self._encoder(sequences_batch, None)
+            return outputs
+
+        # Batches already sorted by decreasing length (for example from a
+        # bucketing data loader) can be packed as they are. Other batches
+        # are sorted when they are packed, and the padded outputs are
+        # returned in their original order.
+        is_sorted = bool((sequences_lengths[:-1] >=
+                          sequences_lengths[1:]).all())
+
+        packed_batch = nn.utils.rnn.pack_padded_sequence(
+            sequences_batch, sequences_lengths, batch_first=True,
+            enforce_sorted=is_sorted)
 
         outputs, _ = self._encoder(packed_batch, None)
 
         outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs,
                                                       batch_first=True)
-        reordered_outputs = outputs.index_select(0, restoration_idx)
 
-        return reordered_outputs
+        return outputs
 
 
 class SoftmaxAttention(nn.Module):
@@ -133,9 +257,29 @@ class SoftmaxAttention(nn.Module):
     The dot product of the encoded vectors in the premises and hypotheses is
     first computed. The softmax of the result is then used in a weighted sum
     of the vectors of the premises for each element of the hypotheses, and
-    conversely for the elements of the premises.
+    conversely for the elements of the premises. The three steps are fused
+    in PyTorch's scaled dot product attention kernel.
     """
 
+    def __init__(self, half_precision=False, compiled=False):
+        """
+        Args:
+            half_precision: If True, the attention is computed in bfloat16
+                when the inputs are on a CUDA device, so that tensor cores
+                can be used. The softmax is still accumulated in float32 by
+                the attention kernel, and the results are cast back to the
+                type of the inputs. Defaults to False.
+            compiled: If True, the computation of the attention is compiled
+                with torch.compile, so that the casts and masking around the
+                attention kernel are fused. Dynamic shapes are enabled since
+                the lengths of the sequences vary between batches. Defaults
+                to False.
+        """
+        super(SoftmaxAttention, self).__init__()
+
+        self.half_precision = half_precision
+        self.compiled = compiled
+
     def forward(self,
                 premise_batch,
                 premise_mask,
@@ -148,13 +292,15 @@ class SoftmaxAttention(nn.Module):
                 size (batch, sequences, vector_dim).
             premise_mask: A mask for the sequences in the premise batch, to
                 ignore padding data in the sequences during the computation of
-                the attention.
+                the attention. Boolean masks and masks of 0s and 1s are both
+                accepted.
             hypothesis_batch: A batch of sequences of vectors representing the
                 hypotheses in some NLI task. The batch is assumed to have the
                 size (batch, sequences, vector_dim).
             hypothesis_mask: A mask for the sequences in the hypotheses batch,
                 to ignore padding data in the sequences during the computation
-                of the attention.
+                of the attention. Boolean masks and masks of 0s and 1s are
+                both accepted.
 
         Returns:
             attended_premises: The sequences of attention vectors for the
@@ -162,24 +308,71 @@ class SoftmaxAttention(nn.Module):
             attended_hypotheses: The sequences of attention vectors for the
                 hypotheses in the input batch.
         """
-        # Dot product between premises and hypotheses in each sequence of
-        # the batch.
-        similarity_matrix = premise_batch.bmm(hypothesis_batch.transpose(2, 1)
-                                                              .contiguous())
-
-        # Softmax attention weights.
-        prem_hyp_attn = masked_softmax(similarity_matrix, hypothesis_mask)
-        hyp_prem_attn = masked_softmax(similarity_matrix.transpose(1, 2)
-                                                        .contiguous(),
-                                       premise_mask)
-
-        # Weighted sums of the hypotheses for the the premises attention,
-        # and vice-versa for the attention of the hypotheses.
-        attended_premises = weighted_sum(hypothesis_batch,
-                                         prem_hyp_attn,
-                                         premise_mask)
-        attended_hypotheses = weighted_sum(premise_batch,
-                                           hyp_prem_attn,
-                                           hypothesis_mask)
-
-        return attended_premises, attended_hypotheses
+        attention = _softmax_attention
+        if self.compiled:
+            attention = _compiled_softmax_attention()
+
+        return attention(premise_batch,
+                         premise_mask,
+                         hypothesis_batch,
+                         hypothesis_mask,
+                         self.half_precision)
+
+
+def _softmax_attention(premise_batch,
+                       premise_mask,
+                       hypothesis_batch,
+                       hypothesis_mask,
+                       half_precision):
+    """
+    Compute the attention for the 'forward' method of SoftmaxAttention.
+
+    The function does not depend on the module, so that the compiled
+    version of it can be shared by all instances of the layer without
+    preventing them from being pickled or copied.
+    """
+    # Boolean masks broadcastable to the size of the similarity matrix
+    # between premises and hypotheses (and its transpose). The masks
+    # must be boolean, since the attention kernel would treat float
+    # masks as additive biases. The conversion is free for bool masks.
+    hyp_attn_mask = hypothesis_mask.bool().unsqueeze(1)
+    prem_attn_mask = premise_mask.bool().unsqueeze(1)
+
+    input_dtype = premise_batch.dtype
+    if half_precision and premise_batch.is_cuda:
+        premise_batch = premise_batch.to(torch.bfloat16)
+        hypothesis_batch = hypothesis_batch.to(torch.bfloat16)
+
+    # The dot product, masked softmax and weighted sum are fused in a
+    # single call to the scaled dot product attention kernel, which
+    # avoids materialising the similarity matrix and attention weights.
+    attended_premises = nn.functional.scaled_dot_product_attention(
+        premise_batch, hypothesis_batch, hypothesis_batch,
+        attn_mask=hyp_attn_mask, scale=1.0)
+    attended_hypotheses = nn.functional.scaled_dot_product_attention(
+        hypothesis_batch, premise_batch, premise_batch,
+        attn_mask=prem_attn_mask, scale=1.0)
+
+    # Mask the attention vectors computed for padding positions.
+    attended_premises = attended_premises.to(input_dtype)\
+        * premise_mask.unsqueeze(-1)
+    attended_hypotheses = attended_hypotheses.to(input_dtype)\
+        * hypothesis_mask.unsqueeze(-1)
+
+    return attended_premises, attended_hypotheses
+
+
+# Compiled version of '_softmax_attention', created on first use.
+_compiled_attention = None
+
+
+def _compiled_softmax_attention():
+    """
+    Get the version of '_softmax_attention' compiled with torch.compile.
+    Dynamic shapes are enabled since the lengths of the sequences vary
+    between batches.
+    """
+    global _compiled_attention
+    if _compiled_attention is None:
+        _compiled_attention = torch.compile(_softmax_attention, dynamic=True)
+    return _compiled_attention
@@ -24,7 +24,9 @@ class ESIM(nn.Module):
                  padding_idx=0,
                  dropout=0.5,
                  num_classes=3,
-                 device="cpu"):
+                 device="cpu",
+                 half_precision_attention=False,
+                 compiled_attention=False):
         """
         Args:
             vocab_size: The size of the vocabulary of embeddings in the model.
@@ -41,7 +43,16 @@ class ESIM(nn.Module):
             num_classes: The number of classes in the output of the network.
                 Defaults to 3.
             device: The name of the device on which the model is being
-                executed. Defaults to 'cpu'.
+                executed. It is not used by the model itself, which runs on
+                the device of its parameters and inputs, but is kept as the
+                'device' attribute read by the training and testing
+                utilities. Defaults to 'cpu'.
+            half_precision_attention: If True, the attention between the
+                premises and hypotheses is computed in bfloat16 when the
+                model runs on a CUDA device. Defaults to False.
+            compiled_attention: If True, the attention between the premises
+                and hypotheses is compiled with torch.compile. Defaults to
+                False.
         """
         super(ESIM, self).__init__()
 
@@ -66,7 +77,9 @@ class ESIM(nn.Module):
                                         self.hidden_size,
                                         bidirectional=True)
 
-        self._attention = SoftmaxAttention()
+        self._attention =\
+            SoftmaxAttention(half_precision=half_precision_attention,
+                             compiled=compiled_attention)
 
         self._projection = nn.Sequential(nn.Linear(4*2*self.hidden_size,
                                                    self.hidden_size),
@@ -112,9 +125,8 @@ class ESIM(nn.Module):
             probabilities: A tensor of size (batch, num_classes) containing
                 the probabilities of each output class in the model.
         """
-        premises_mask = get_mask(premises, premises_lengths).to(self.device)
-        hypotheses_mask = get_mask(hypotheses, hypotheses_lengths)\
-            .to(self.device)
+        premises_mask = get_mask(premises, premises_lengths)
+        hypotheses_mask = get_mask(hypotheses, hypotheses_lengths)
 
         embedded_premises = self._word_embedding(premises)
         embedded_hypotheses = self._word_embedding(hypotheses)
@@ -155,11 +167,14 @@ class ESIM(nn.Module):
         v_ai = self._composition(projected_premises, premises_lengths)
         v_bj = self._composition(projected_hypotheses, hypotheses_lengths)
 
-        v_a_avg = torch.sum(v_ai * premises_mask.unsqueeze(1)
-                                                .transpose(2, 1), dim=1)\
+        # The masked sums over the sequences are contracted with einsum,
+        # without transposing the masks or materialising masked copies of
+        # the encoded sequences.
+        v_a_avg = torch.einsum("bsd,bs->bd",
+                               v_ai, premises_mask.to(v_ai.dtype))\
             / torch.sum(premises_mask, dim=1, keepdim=True)
-        v_b_avg = torch.sum(v_bj * hypotheses_mask.unsqueeze(1)
-                                                  .transpose(2, 1), dim=1)\
+        v_b_avg = torch.einsum("bsd,bs->bd",
+                               v_bj, hypotheses_mask.to(v_bj.dtype))\
             / torch.sum(hypotheses_mask, dim=1, keepdim=True)
 
         v_a_max, _ = replace_masked(v_ai, premises_mask, -1e7).max(dim=1)
@@ -57,48 +57,50 @@ def get_mask(sequences_batch, sequences_lengths):
             'sequences_batch'. Must be of size (batch).
 
     Returns:
-        A mask of size (batch, max_sequence_length), where max_sequence_length
-        is the length of the longest sequence in the batch.
+        A boolean mask of size (batch, max_sequence_length), where
+        max_sequence_length is the length of the longest sequence in the
+        batch. The mask is False at padding positions and True everywhere
+        else, and it is on the same device as 'sequences_batch'.
     """
-    batch_size = sequences_batch.size()[0]
-    max_length = torch.max(sequences_lengths)
-    mask = torch.ones(batch_size, max_length, dtype=torch.float)
-    mask[sequences_batch[:, :max_length] == 0] = 0.0
-    return mask
+    max_length = int(torch.max(sequences_lengths))
+    return sequences_batch[:, :max_length] != 0
 
 
 # Code widely inspired from:
 # https://github.com/allenai/allennlp/blob/master/allennlp/nn/util.py.
-def masked_softmax(tensor, mask):
+def masked_softmax(tensor, mask, dim=-1):
     """
-    Apply a masked softmax on the last dimension of a tensor.
-    The input tensor and mask should be of size (batch, *, sequence_length).
+    Apply a masked softmax on a dimension of a tensor.
+    The input tensor should be of size (batch, *, sequence_length).
 
     Args:
         tensor: The tensor on which the softmax function must be applied along
-            the last dimension.
-        mask: A mask of the same size as the tensor with 0s in the positions of
-            the values that must be masked and 1s everywhere else.
+            the dimension 'dim'.
+        mask: A mask with False (or 0) in the positions of the values that
+            must be masked and True (or 1) everywhere else. Boolean masks and
+            masks of 0s and 1s are both accepted. It must be broadcastable
+            to the size of the tensor once it has been unsqueezed on its
+            second dimension until it has as many dimensions as the tensor.
+            At least one value must be left unmasked along 'dim' in every
+            slice.
+        dim: The dimension along which the softmax is computed. Softmax over
+            a non-contiguous view (such as a transposed tensor) can be applied
+            directly by choosing the right dimension, without copying the
+            data. Defaults to -1.
 
     Returns:
         A tensor of the same size as the inputs containing the result of the
         softmax.
     """
-    tensor_shape = tensor.size()
-    reshaped_tensor = tensor.view(-1, tensor_shape[-1])
-
-    # Reshape the mask so it matches the size of the input tensor.
+    # Reshape the mask so it can be broadcast to the size of the input tensor.
     while mask.dim() < tensor.dim():
         mask = mask.unsqueeze(1)
-    mask = mask.expand_as(tensor).contiguous().float()
-    reshaped_mask = mask.view(-1, mask.size()[-1])
 
-    result = nn.functional.softmax(reshaped_tensor * reshaped_mask, dim=-1)
-    result = result * reshaped_mask
-    # 1e-13 is added to avoid divisions by zero.
-    result = result / (result.sum(dim=-1, keepdim=True) + 1e-13)
+    # Masked values are set to -inf so that a single softmax gives them a
+    # weight of 0, without having to renormalise the result.
+    masked_tensor = tensor.masked_fill(~mask.bool(), float("-inf"))
 
-    return result.view(*tensor_shape)
+    return nn.functional.softmax(masked_tensor, dim=dim)
 
 
 # Code widely inspired from:
@@ -106,25 +108,27 @@ def masked_softmax(tensor, mask):
 def weighted_sum(tensor, weights, mask):
     """
     Apply a weighted sum on the vectors along the last dimension of 'tensor',
-    and mask the vectors in the result with 'mask'.
+    where the rows of 'weights' masked in 'mask' are set to zero before the
+    sum is computed.
 
     Args:
         tensor: A tensor of vectors on which a weighted sum must be applied.
         weights: The weights to use in the weighted sum.
-        mask: A mask to apply on the result of the weighted sum.
+        mask: A mask over the rows of 'weights', with False (or 0) for the
+            rows whose weighted sums must be zero and True (or 1) everywhere
+            else. Boolean masks and masks of 0s and 1s are both accepted.
 
     Returns:
-        A new tensor containing the result of the weighted sum after the mask
-        has been applied on it.
+        A new tensor containing the result of the weighted sum, with zero
+        vectors in the positions masked in 'mask'.
     """
-    weighted_sum = weights.bmm(tensor)
-
-    while mask.dim() < weighted_sum.dim():
+    # The mask is applied on the rows of the weights rather than on the
+    # result, so that the output of the product is already masked.
+    while mask.dim() < weights.dim():
         mask = mask.unsqueeze(1)
     mask = mask.transpose(-1, -2)
-    mask = mask.expand_as(weighted_sum).contiguous().float()
 
-    return weighted_sum * mask
+    return (weights * mask).bmm(tensor)
 
 
 # Code inspired from:
@@ -137,8 +141,9 @@ def replace_masked(tensor, mask, value):
     Args:
         tensor: The tensor in which the masked vectors must have their values
             replaced.
-        mask: A mask indicating the vectors which must have their values
-            replaced.
+        mask: A mask that is False (or 0) for the vectors which must have
+            their values replaced. Boolean masks and masks of 0s and 1s are
+            both accepted.
         value: The value to place in the masked vectors of 'tensor'.
 
     Returns:
@@ -146,9 +151,7 @@ def replace_masked(tensor, mask, value):
         vectors masked in 'mask' were replaced by 'value'.
     """
     mask = mask.unsqueeze(1).transpose(2, 1)
-    reverse_mask = 1.0 - mask
-    values_to_add = value * reverse_mask
-    return tensor * mask + values_to_add
+    return tensor.masked_fill(~mask.bool(), value)
 
 
 def correct_predictions(output_probabilities, targets):
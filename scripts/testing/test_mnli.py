@@ -39,11 +39,13 @@ def predict(model, dataloader, labeldict):
         for batch in dataloader:
 
             # Move input and output data to the GPU if one is used.
+            # Sequence lengths stay on the CPU, where they are needed to pack
+            # the sequences in the encoders.
             ids = batch["id"]
             premises = batch['premise'].to(device)
-            premises_lengths = batch['premise_length'].to(device)
+            premises_lengths = batch['premise_length']
             hypotheses = batch['hypothesis'].to(device)
-            hypotheses_lengths = batch['hypothesis_length'].to(device)
+            hypotheses_lengths = batch['hypothesis_length']
 
             _, probs = model(premises,
                              premises_lengths,
@@ -41,10 +41,12 @@ def test(model, dataloader):
             batch_start = time.time()
 
             # Move input and output data to the GPU if one is used.
+            # Sequence lengths stay on the CPU, where they are needed to pack
+            # the sequences in the encoders.
             premises = batch["premise"].to(device)
-            premises_lengths = batch["premise_length"].to(device)
+            premises_lengths = batch["premise_length"]
             hypotheses = batch["hypothesis"].to(device)
-            hypotheses_lengths = batch["hypothesis_length"].to(device)
+            hypotheses_lengths = batch["hypothesis_length"]
             labels = batch["label"].to(device)
 
             _, probs = model(premises,
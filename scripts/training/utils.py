@@ -48,10 +48,12 @@ def train(model,
         batch_start = time.time()
 
         # Move input and output data to the GPU if it is used.
+        # Sequence lengths stay on the CPU, where they are needed to pack
+        # the sequences in the encoders.
         premises = batch["premise"].to(device)
-        premises_lengths = batch["premise_length"].to(device)
+        premises_lengths = batch["premise_length"]
         hypotheses = batch["hypothesis"].to(device)
-        hypotheses_lengths = batch["hypothesis_length"].to(device)
+        hypotheses_lengths = batch["hypothesis_length"]
         labels = batch["label"].to(device)
 
         optimizer.zero_grad()
@@ -112,10 +114,12 @@ def validate(model, dataloader, criterion):
     with torch.no_grad():
         for batch in dataloader:
             # Move input and output data to the GPU if one is used.
+            # Sequence lengths stay on the CPU, where they are needed to pack
+            # the sequences in the encoders.
             premises = batch["premise"].to(device)
-            premises_lengths = batch["premise_length"].to(device)
+            premises_lengths = batch["premise_length"]
             hypotheses = batch["hypothesis"].to(device)
-            hypotheses_lengths = batch["hypothesis_length"].to(device)
+            hypotheses_lengths = batch["hypothesis_length"]
             labels = batch["label"].to(device)
 
             logits, probs = model(premises,